@@ -1,11 +1,19 @@
 import datetime
+import functools
+import inspect
 import math
+import multiprocessing
 import os
 import random
 from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from typing import Deque, Dict, List, Tuple
 
 import gym
+import matplotlib
+
+matplotlib.use('Agg')  # non-interactive backend, figures are written with savefig
+import matplotlib.dates as mdates
 import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
@@ -20,6 +28,12 @@ from rl_plotter.logger import Logger
 
 from segment_tree import MinSegmentTree, SumSegmentTree
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, run the scans as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
+
 
 class ReplayBuffer:
     """A simple numpy replay buffer."""
@@ -108,8 +122,8 @@ class ReplayBuffer:
         # info of the last transition
         rew, next_obs, done = n_step_buffer[-1][-3:]
 
-        for transition in reversed(list(n_step_buffer)[:-1]):
-            r, n_o, d = transition[-3:]
+        for k in range(len(n_step_buffer) - 2, -1, -1):
+            r, n_o, d = n_step_buffer[k][-3:]
 
             rew = r + gamma * rew * (1 - d)
             next_obs, done = (n_o, d) if d else (next_obs, done)
@@ -485,6 +499,14 @@ class DQNAgent:
             self.v_min, self.v_max, self.atom_size
         ).to(self.device)
 
+        # flat-index offset of each row for the categorical projection
+        self._proj_offset = (
+            (torch.arange(batch_size, device=self.device) * atom_size)
+            .view(-1, 1)
+            .expand(batch_size, atom_size)
+            .contiguous()
+        )
+
         # networks: dqn, dqn_target
         self.dqn = Network(
             obs_dim, action_dim, self.atom_size, self.support
@@ -681,15 +703,7 @@ class DQNAgent:
             b = (t_z - self.v_min) / delta_z
             l = b.floor().long()
             u = b.ceil().long()
-
-            offset = (
-                torch.linspace(
-                    0, (self.batch_size - 1) * self.atom_size, self.batch_size
-                ).long()
-                .unsqueeze(1)
-                .expand(self.batch_size, self.atom_size)
-                .to(self.device)
-            )
+            offset = self._proj_offset
 
             proj_dist = torch.zeros(next_dist.size(), device=self.device)
             proj_dist.view(-1).index_add_(
@@ -830,10 +844,96 @@ import random
 
 
 def sigmoid(inx):
-    if inx >= 0:  # 对sigmoid函数的优化，避免了出现极大的数据溢出
-        return 1.0 / (1 + np.exp(-inx))
-    else:
-        return np.exp(inx) / (1 + np.exp(inx))
+    # 对sigmoid函数的优化，避免了出现极大的数据溢出; element-wise on arrays
+    z = np.exp(-np.abs(inx))
+    return np.where(np.asarray(inx) >= 0, 1.0 / (1 + z), z / (1 + z))
+
+
+def build_observations(states, position_value, remain_t):
+    """Stack agent observations [position value, remaining time, window] of every step.
+    Args:
+        states: (episodes, cycle_T, wnd_t) normalized price windows
+        position_value: (episodes, cycle_T) sigmoid of price minus reference price
+        remain_t: (cycle_T,) remaining time of every day
+    Returns:
+        contiguous float32 array of shape (episodes, cycle_T, wnd_t + 2)
+    """
+    states = np.asarray(states, dtype=np.float32)
+    obs = np.empty(states.shape[:2] + (states.shape[2] + 2,), dtype=np.float32)
+    obs[..., 0] = position_value
+    obs[..., 1] = remain_t
+    obs[..., 2:] = states
+    return obs
+
+
+def obs_to_device(obs, device):
+    """Copy an observation array to device in one transfer, pinned on CUDA."""
+    obs = torch.from_numpy(np.ascontiguousarray(obs, dtype=np.float32))
+    if device.type == "cuda":
+        obs = obs.pin_memory()
+    return obs.to(device, non_blocking=True)
+
+
+@njit(cache=True)
+def scan_episodes(actions, prices, cycle_T):
+    """Find the buy day of every episode.
+    Args:
+        actions: (episodes, cycle_T) greedy actions, 1 for buy
+        prices: (episodes, cycle_T) daily prices
+        cycle_T: investment cycle
+    Returns:
+        picked, first-day and last-day prices and the buy day of every episode
+    """
+    num_episodes = actions.shape[0]
+    p_price = np.empty(num_episodes)
+    first_price = np.empty(num_episodes)
+    last_price = np.empty(num_episodes)
+    stop_idx = np.empty(num_episodes, dtype=np.int64)
+    for e in range(num_episodes):
+        # buy on the last day if the agent never does
+        t = cycle_T - 1
+        for k in range(cycle_T):
+            if actions[e, k] == 1:
+                t = k
+                break
+        stop_idx[e] = t
+        p_price[e] = prices[e, t]
+        first_price[e] = prices[e, 0]
+        last_price[e] = prices[e, cycle_T - 1]
+    return p_price, first_price, last_price, stop_idx
+
+
+@functools.lru_cache(maxsize=1)
+def evaluation_agent():
+    """Agent shell shared by the evaluation functions, only its dqn is swapped."""
+    return DQNAgent(env, memory_size, batch_size, target_update)
+
+
+@functools.lru_cache(maxsize=8)
+def load_dqn(path):
+    """Load a trained network once per path, ready for inference."""
+    # the checkpoints are whole pickled modules, which newer torch refuses to
+    # unpickle unless weights_only is turned off (older torch has no such flag)
+    load_kwargs = {}
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        load_kwargs["weights_only"] = False
+    dqn = torch.load(path, map_location=evaluation_agent().device, **load_kwargs)
+    dqn.eval()
+    dqn.requires_grad_(False)
+    return dqn
+
+
+@functools.lru_cache(maxsize=16)
+def make_test_env(test_data, wnd_t, cycle_T):
+    """Build an evaluation env once per (price tuple, window, cycle).
+
+    The env shuffles its episode order with np.random on construction; the
+    global state is restored so cached and fresh envs leave the same stream.
+    """
+    state = np.random.get_state()
+    test_env = gym.make('CryptoEnv-v0', data=list(test_data), wnd_t=wnd_t, cycle_T=cycle_T)
+    np.random.set_state(state)
+    return test_env
 
 
 def rainbowevaluate():
@@ -851,62 +951,42 @@ def rainbowevaluate():
     random.seed(seed)
     seed_torch(seed)
     env.seed(seed)
-    agent = DQNAgent(env, memory_size, batch_size, target_update)
-    agent.dqn = torch.load('D://SJTU-STUDY//Research//NUS//Optimal Stopping//RLforDAC//rainbow//good//46.pth')
-    agent.dqn.eval()
+    agent = evaluation_agent()
+    agent.dqn = load_dqn('D://SJTU-STUDY//Research//NUS//Optimal Stopping//RLforDAC//rainbow//good//46.pth')
 
-    for test_data in test_data_list:
-        test_env = gym.make('CryptoEnv-v0', data=test_data, wnd_t=wnd_t, cycle_T=cycle_T)
+    for i, test_data in enumerate(test_data_list):
+        test_env = make_test_env(tuple(test_data), wnd_t, cycle_T)
         ev_episodes = test_env.prepare_episodes()
         original_episodes = test_env.prepare_original_episodes()
-
-        e = 0
-        random_list = []
-        p_list = []
-        first_day = []
-        last_day = []
-        ratio1 = []
-        ratio2 = []
-        ratio3 = []
-        t_list = []
-        visual_price = []
-        for episode in ev_episodes:
-            refer_value = original_episodes[e][0][-2]
-            t = 0
-            for state in episode:
-                remain_t = (cycle_T - t) / cycle_T
-                price = original_episodes[e][t][-1]
-                position_value = sigmoid(price - refer_value)
-                obs = (np.concatenate(([position_value, remain_t], state)))
-                obs = obs.reshape(1, wnd_t + 2)
-
-                action = agent.dqn(
-                    torch.FloatTensor(obs).to('cuda')
-                ).argmax()
-                action = action.detach().cpu().numpy()
-
-                if action == 1 or t == cycle_T - 1:
-                    p_list.append(original_episodes[e][t][-1])
-                    first_day.append(original_episodes[e][0][-1])
-                    last_day.append(original_episodes[e][-1][-1])
-                    random_t = random.randint(0, cycle_T - 1)
-                    random_list.append(original_episodes[e][random_t][-1])
-                    period_price_list = [original_episodes[e][i][-1] for i in range(cycle_T)]
-
-                    if e % cycle_T == 0:
-                        # print('current e:%d'%e)
-                        t_list.append(int(wnd_t + cycle_T * int(e // cycle_T) + t - 1))
-                        visual_price.append(original_episodes[e][t][-1])
-                    break
-                t += 1
-            e += 1
-            p_amount = np.sum(np.array([10000 / i for i in p_list]))
-            f_amount = np.sum(np.array([10000 / i for i in first_day]))
-            l_amount = np.sum(np.array([10000 / i for i in last_day]))
-            r_amount = np.sum(np.array([10000 / i for i in random_list]))
-            ratio1.append((p_amount - f_amount) / f_amount * 100)
-            ratio2.append((p_amount - l_amount) / l_amount * 100)
-            ratio3.append((p_amount - r_amount) / r_amount * 100)
+        # position value and remaining time of every step, computed once
+        prices = np.asarray(original_episodes, dtype=np.float64)
+        prices_mat, refer_mat = prices[..., -1], prices[..., -2]
+        pv = sigmoid(prices_mat - refer_mat[:, :1])
+        remain = (cycle_T - np.arange(cycle_T)) / cycle_T
+        obs_all = obs_to_device(build_observations(ev_episodes, pv, remain), agent.device)
+
+        # every step of every episode in a single forward pass
+        num_episodes = len(ev_episodes)
+        with torch.inference_mode():
+            actions = agent.dqn(obs_all.view(-1, wnd_t + 2)).argmax(1)
+        actions = actions.view(num_episodes, cycle_T).cpu().numpy()
+        p_list, first_day, last_day, stop_t = scan_episodes(actions, np.ascontiguousarray(prices_mat), cycle_T)
+
+        # random-day baseline of every episode
+        rand_ts = np.random.randint(0, cycle_T, size=num_episodes)
+        random_list = prices_mat[np.arange(num_episodes), rand_ts]
+        # episodes starting a new cycle are also plotted
+        cycles = np.arange(0, num_episodes, cycle_T)
+        t_list = wnd_t + cycles + stop_t[cycles] - 1
+        visual_price = p_list[cycles]
+        # total amount bought after each episode
+        p_amount = np.cumsum(10000.0 / p_list)
+        f_amount = np.cumsum(10000.0 / first_day)
+        l_amount = np.cumsum(10000.0 / last_day)
+        r_amount = np.cumsum(10000.0 / random_list)
+        ratio1 = (p_amount - f_amount) / f_amount * 100
+        ratio2 = (p_amount - l_amount) / l_amount * 100
+        ratio3 = (p_amount - r_amount) / r_amount * 100
         print("Compared with always buy on the first day: %.2f %%" % np.mean(np.array(ratio1)))
         print("Compared with always buy on the last day: %.2f %%" % np.mean(np.array(ratio2)))
         print("Compared with always buy on a random day: %.2f %%" % np.mean(np.array(ratio3)))
@@ -916,28 +996,25 @@ def rainbowevaluate():
         plt.figure(1, figsize=[16, 9])
         plt.plot(range(len(test_data)), test_data, color='b', label='Price')
         print(len(t_list))
-        for i in range(len(t_list) + 1):
-            plt.axvline(x=i * cycle_T + wnd_t - 1, c='g', ls='--', lw=1)  # vertical
+        # full-height cycle boundaries (x in data, y in axes coordinates)
+        plt.vlines(np.arange(len(t_list) + 1) * cycle_T + wnd_t - 1, 0, 1,
+                   transform=plt.gca().get_xaxis_transform(), colors='g', linestyles='--', linewidths=1)  # vertical
         # for i in range(int((len(test_data)-wnd_t)//cycle_T)+1):
         #     plt.axvline(x=i * cycle_T + wnd_t, c='g', ls='--', lw=1)  # vertical
         # for j in range(len(t_list)):
         #     plt.scatter(t_list[j], test_data[t_list[j]], s=20, c='r')  # stroke, colour
-        for j in range(len(t_list)):
-            plt.scatter(t_list[j], visual_price[j], s=20, c='r')  # stroke, colour
+        plt.scatter(t_list, visual_price, s=20, c='r')  # stroke, colour
         plt.title("The performance of the DQN", fontsize=15)
         plt.legend()
-        plt.show()
+        # plt.show()
+        plt.savefig("./DQN_Performance_%d.jpg" % i)
+        plt.close()
 
 
 def date_range(beginDate, endDate, interval=1):
-    dates = []
-    dt = datetime.datetime.strptime(beginDate, "%Y%m%d")
-    date = beginDate[:]
-    while date <= endDate:
-        dates.append(date)
-        dt = dt + datetime.timedelta(interval)
-        date = dt.strftime("%Y%m%d")
-    return dates
+    dates = pd.date_range(pd.to_datetime(beginDate, format="%Y%m%d"), pd.to_datetime(endDate, format="%Y%m%d"),
+                          freq="%dD" % interval)
+    return dates.strftime("%Y%m%d").tolist()
 
 
 def dateAdd(date, interval=1):
@@ -947,7 +1024,7 @@ def dateAdd(date, interval=1):
     return date1
 
 
-def SingleRainbowEvaluate(path, stat=136, model_id=47, T=9, num=0):
+def SingleRainbowEvaluate(path, stat=136, model_id=47, T=9, num=0, plot=False):
     F = open(r'../data/Eva_Data.pkl', 'rb')
     content = pickle.load(F)
     total_data, start_date = GetPriceList(content, name_num=num)  # 0 for BTC price data
@@ -960,74 +1037,55 @@ def SingleRainbowEvaluate(path, stat=136, model_id=47, T=9, num=0):
     random.seed(seed)
     seed_torch(seed)
     env.seed(seed)
-    agent = DQNAgent(env, memory_size, batch_size, target_update)
-    agent.dqn = torch.load(path)
-    agent.dqn.eval()
+    agent = evaluation_agent()
+    agent.dqn = load_dqn(path)
 
     cycle_T = T
 
     for test_data in test_data_list:
-        test_env = gym.make('CryptoEnv-v0', data=test_data, wnd_t=wnd_t, cycle_T=cycle_T)
+        test_env = make_test_env(tuple(test_data), wnd_t, cycle_T)
         ev_episodes = test_env.prepare_episodes()
         original_episodes = test_env.prepare_original_episodes()
 
-        e = 0
-        random_list = []
-        p_list = []
-        first_day = []
-        last_day = []
-        avg_day = []
         ratio1 = []
         ratio2 = []
         ratio3 = []
         ratio4 = []
-        t_list = []
-        visual_price = []
-
-        for episode in ev_episodes:
-            if e % cycle_T != 0:
-                e += 1
-                continue
-            refer_value = original_episodes[e][0][-2]
-            t = 0
-            for state in episode:
-                remain_t = (cycle_T - t) / cycle_T
-                price = original_episodes[e][t][-1]
-                position_value = sigmoid(price - refer_value)
-                obs = (np.concatenate(([position_value, remain_t], state)))
-                obs = obs.reshape(1, wnd_t + 2)
-
-                action = agent.dqn(
-                    torch.FloatTensor(obs).to('cuda')
-                ).argmax()
-                action = action.detach().cpu().numpy()
-
-                if action == 1 or t == cycle_T - 1:
-                    p_list.append(original_episodes[e][t][-1])
-                    first_day.append(original_episodes[e][0][-1])
-                    last_day.append(original_episodes[e][-1][-1])
-                    random_t = random.randint(0, cycle_T - 1)
-                    random_list.append(original_episodes[e][random_t][-1])
-                    period_price_list = [original_episodes[e][i][-1] for i in range(cycle_T)]
-                    avg_day.append(np.mean(np.array(period_price_list)))
-                    if e % cycle_T == 0:
-                        t_list.append(int(wnd_t + cycle_T * int(e // cycle_T) + t - 1))
-                        if original_episodes[e][t][-1] >= np.mean(np.array(period_price_list)):
-                            visual_price.append(original_episodes[e][t][-1])
-                        else:
-                            visual_price.append(-original_episodes[e][t][-1])
-                    break
-                t += 1
-            e += 1
-        p_amount = np.sum(np.array([10000 / i for i in p_list]))
-        p_amount_list = np.array([10000 / i for i in p_list])
-        f_amount = np.sum(np.array([10000 / i for i in first_day]))
-        f_amount_list = (np.array([10000 / i for i in first_day]))
-        l_amount = np.sum(np.array([10000 / i for i in last_day]))
-        l_amount_list = (np.array([10000 / i for i in last_day]))
-        r_amount = np.sum(np.array([10000 / i for i in random_list]))
-        avg_amount = np.sum(np.array([10000 / i for i in avg_day]))
-        avg_amount_list = (np.array([10000 / i for i in avg_day]))
+
+        # observations of every step of the episodes starting a new cycle,
+        # evaluated in a single forward pass: (episodes, cycle_T, wnd_t + 2)
+        starts = range(0, len(ev_episodes), cycle_T)
+        states = np.asarray([ev_episodes[e] for e in starts], dtype=np.float32)
+        prices = np.asarray([original_episodes[e] for e in starts], dtype=np.float64)
+        prices_mat, refer_mat = prices[..., -1], prices[..., -2]
+        position_value = sigmoid(prices_mat - refer_mat[:, :1])
+        remain_t = (cycle_T - np.arange(cycle_T)) / cycle_T
+        obs = obs_to_device(build_observations(states, position_value, remain_t), agent.device)
+
+        with torch.inference_mode():
+            actions = agent.dqn(obs.view(-1, wnd_t + 2)).argmax(1)
+        actions = actions.view(len(starts), cycle_T).cpu().numpy()
+        p_list, first_day, last_day, stop_t = scan_episodes(
+            actions, np.ascontiguousarray(prices_mat), cycle_T
+        )
+        rand_t = np.random.randint(0, cycle_T, size=len(starts))
+        avg_day = prices_mat.mean(axis=1)
+
+        cycles = np.arange(len(starts))
+        random_list = prices_mat[cycles, rand_t]
+        t_list = wnd_t + cycle_T * cycles + stop_t - 1
+        # negative prices mark buys below the cycle's average price
+        visual_price = np.where(p_list >= avg_day, p_list, -p_list)
+        p_amount_list = 10000.0 / p_list
+        f_amount_list = 10000.0 / first_day
+        l_amount_list = 10000.0 / last_day
+        r_amount_list = 10000.0 / random_list
+        avg_amount_list = 10000.0 / avg_day
+        p_amount = p_amount_list.sum()
+        f_amount = f_amount_list.sum()
+        l_amount = l_amount_list.sum()
+        r_amount = r_amount_list.sum()
+        avg_amount = avg_amount_list.sum()
         ratio1.append((p_amount - f_amount) / f_amount * 100)
         ratio2.append((p_amount - l_amount) / l_amount * 100)
         ratio3.append((p_amount - r_amount) / r_amount * 100)
@@ -1037,6 +1095,10 @@ def SingleRainbowEvaluate(path, stat=136, model_id=47, T=9, num=0):
         print("Compared with always buy on a random day: %.2f %%" % np.mean(np.array(ratio3)))
         print("Compared with buy on the average price: %.2f %%" % np.mean(np.array(ratio4)))
 
+        # the figure is only needed when the result image is kept
+        if not plot:
+            continue
+
         # plt.figure(1, figsize=[16, 9])
         # plt.plot(range(len(test_data)), test_data, label='Price')
 
@@ -1051,19 +1113,25 @@ def SingleRainbowEvaluate(path, stat=136, model_id=47, T=9, num=0):
         plt.ylabel('The price of ETH', fontsize=15)
         plt.yticks(fontsize=14)
         plt.xlabel('Datetime', fontsize=15)
-        xs = [datetime.datetime.strptime(d, '%Y%m%d').date() for d in test_list_data]
+        xs = pd.to_datetime(test_list_data, format='%Y%m%d').date
         # plt.xticks(ticks=pd.date_range('2022-08-29', '2022-11-07', freq='1d'), fontsize=12)
         ax.plot(xs, test_data_list[0][25:], color='black', label='ETH')
         print(test_data_list[0][25:])
         print(len(test_data_list[0][25:]))
         i = 0
         up = 200
+        # alternating dark / light bands, one per investment cycle, drawn as two artists
+        x_num = mdates.date2num(xs)
+        y_low, y_high = min(test_data[25:]) - up, max(test_data[25:]) + up
+        dark_bands, light_bands = [], []
         while 5 + (i + 1) * T <= len(xs):
-            plt.fill_between(xs[5 + i * T - 1:5 + (i + 1) * T], min(test_data[25:]) - up, max(test_data[25:]) + up,
-                             facecolor='grey', alpha=0.2)
-            plt.fill_between(xs[5 + (i + 1) * T - 1:5 + (i + 2) * T], min(test_data[25:]) - up, max(test_data[25:]) + up,
-                             facecolor='grey', alpha=0.1)
+            begin, middle = 5 + i * T - 1, 5 + (i + 1) * T - 1
+            end = min(5 + (i + 2) * T, len(xs)) - 1
+            dark_bands.append((x_num[begin], x_num[middle] - x_num[begin]))
+            light_bands.append((x_num[middle], x_num[end] - x_num[middle]))
             i += 2
+        ax.broken_barh(dark_bands, (y_low, y_high - y_low), facecolors='grey', alpha=0.2)
+        ax.broken_barh(light_bands, (y_low, y_high - y_low), facecolors='grey', alpha=0.1)
 
         # for i in range(len(t_list) + 1):
         #     plt.axvline(x=i * cycle_T + wnd_t - 1, c='g', ls='--', lw=1)  # vertical
@@ -1071,12 +1139,12 @@ def SingleRainbowEvaluate(path, stat=136, model_id=47, T=9, num=0):
         # #     plt.axvline(x=i * cycle_T + wnd_t, c='g', ls='--', lw=1)  # vertical
         # # for j in range(len(t_list)):
         # #     plt.scatter(t_list[j], test_data[t_list[j]], s=20, c='r')  # stroke, colour
-        for j in range(len(t_list)):
-            print(xs[t_list[j] - 25])
-            if visual_price[j] > 0:
-                plt.scatter(xs[t_list[j] - 25], visual_price[j], s=20, c='g')  # stroke, colour    
-            else:
-                plt.scatter(xs[t_list[j] - 25], -visual_price[j], s=20, c='r')
+        buy_dates = xs[t_list - 25]
+        print(buy_dates)
+        # green: bought above the cycle's average price, red: below
+        above = visual_price > 0
+        plt.scatter(buy_dates[above], visual_price[above], s=20, c='g')  # stroke, colour
+        plt.scatter(buy_dates[~above], -visual_price[~above], s=20, c='r')
         plt.title("The performance on ETH test data", fontsize=17)
         plt.legend(fontsize=14)
         # plt.show()
@@ -1085,6 +1153,13 @@ def SingleRainbowEvaluate(path, stat=136, model_id=47, T=9, num=0):
         plt.close()
 
 
+def run_one(T, model_id, path):
+    """Evaluate one (T, model) pair of the sweep, used as a process pool task."""
+    print("Currently T = %d" % T)
+    SingleRainbowEvaluate(path=path, stat=127, model_id=model_id, T=T, num=1, plot=True)
+    print(" ")
+
+
 if __name__ == '__main__':
     # rainbowtrain(num_frames)
     # rainbowevaluate()
@@ -1104,9 +1179,14 @@ if __name__ == '__main__':
     #                           stat= 136, model_id=model_id, T=T, num=1)
     #     print(" ")
 
-    for T in T_list:
-        model_id = 35
-        print("Currently T = %d" % T)
-        SingleRainbowEvaluate(path='./models/ETH_0.5Reward_Gamma0_95_Rainbow_30_9/Seed999_Step_500k/%s.pth' % model_id,
-                              stat= 127, model_id=model_id, T=T, num=1)
-        print(" ")
+    model_id = 35
+    path = './models/ETH_0.5Reward_Gamma0_95_Rainbow_30_9/Seed999_Step_500k/%s.pth' % model_id
+    if len(T_list) == 1:
+        # a single T is not worth the cost of spawning a worker
+        for T in T_list:
+            run_one(T, model_id, path)
+    else:
+        # every T is evaluated independently; spawn keeps CUDA usable in the workers
+        with ProcessPoolExecutor(max_workers=min(len(T_list), os.cpu_count() or 1),
+                                 mp_context=multiprocessing.get_context("spawn")) as executor:
+            list(executor.map(run_one, T_list, [model_id] * len(T_list), [path] * len(T_list)))
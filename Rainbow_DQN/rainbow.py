@@ -1,4 +1,6 @@
 import datetime
+import functools
+import inspect
 import math
 import os
 import random
@@ -13,17 +15,77 @@ import torch.optim as optim
 import pickle
 import random
 from collections import deque
-from typing import Deque, Dict, List, Tuple
+from typing import Dict, List, Tuple
 from IPython.display import clear_output
 from torch.nn.utils import clip_grad_norm_
 from rl_plotter.logger import Logger
 from segment_tree import MinSegmentTree, SumSegmentTree
 
+try:
+    from numba import njit
+except ImportError:  # numba is optional, run the scans as plain Python
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+
 def sigmoid(inx):
-    if inx >= 0:
-        return 1.0 / (1 + np.exp(-inx))
-    else:
-        return np.exp(inx) / (1 + np.exp(inx))
+    # overflow-safe, element-wise on arrays
+    z = np.exp(-np.abs(inx))
+    return np.where(np.asarray(inx) >= 0, 1.0 / (1 + z), z / (1 + z))
+
+
+def build_observations(states, position_value, remain_t):
+    """Stack agent observations [position value, remaining time, window] of every step.
+    Args:
+        states: (episodes, cycle_T, wnd_t) normalized price windows
+        position_value: (episodes, cycle_T) sigmoid of price minus reference price
+        remain_t: (cycle_T,) remaining time of every day
+    Returns:
+        contiguous float32 array of shape (episodes, cycle_T, wnd_t + 2)
+    """
+    states = np.asarray(states, dtype=np.float32)
+    obs = np.empty(states.shape[:2] + (states.shape[2] + 2,), dtype=np.float32)
+    obs[..., 0] = position_value
+    obs[..., 1] = remain_t
+    obs[..., 2:] = states
+    return obs
+
+
+def obs_to_device(obs, device):
+    """Copy an observation array to device in one transfer, pinned on CUDA."""
+    obs = torch.from_numpy(np.ascontiguousarray(obs, dtype=np.float32))
+    if device.type == "cuda":
+        obs = obs.pin_memory()
+    return obs.to(device, non_blocking=True)
+
+
+@njit(cache=True)
+def scan_episodes(actions, prices, cycle_T):
+    """Find the buy day of every episode.
+    Args:
+        actions: (episodes, cycle_T) greedy actions, 1 for buy
+        prices: (episodes, cycle_T) daily prices
+        cycle_T: investment cycle
+    Returns:
+        picked, first-day and last-day prices and the buy day of every episode
+    """
+    num_episodes = actions.shape[0]
+    p_price = np.empty(num_episodes)
+    first_price = np.empty(num_episodes)
+    last_price = np.empty(num_episodes)
+    stop_idx = np.empty(num_episodes, dtype=np.int64)
+    for e in range(num_episodes):
+        # buy on the last day if the agent never does
+        t = cycle_T - 1
+        for k in range(cycle_T):
+            if actions[e, k] == 1:
+                t = k
+                break
+        stop_idx[e] = t
+        p_price[e] = prices[e, t]
+        first_price[e] = prices[e, 0]
+        last_price[e] = prices[e, cycle_T - 1]
+    return p_price, first_price, last_price, stop_idx
 
 
 class ReplayBuffer:
@@ -33,89 +95,148 @@ class ReplayBuffer:
             size: int,
             batch_size: int = 128,
             n_step: int = 3,
-            gamma: float = 0.95
+            gamma: float = 0.95,
+            device: torch.device = None,
+            mmap_path: str = None,
     ):
-        self.obs_buf = np.zeros([size, obs_dim], dtype=np.float32)
-        self.next_obs_buf = np.zeros([size, obs_dim], dtype=np.float32)
-        self.acts_buf = np.zeros([size], dtype=np.float32)
-        self.rews_buf = np.zeros([size], dtype=np.float32)
-        self.done_buf = np.zeros(size, dtype=np.float32)
+        # transitions live on the training device, so sampling needs no copy;
+        # with mmap_path they stay in host memory and observations are backed
+        # by files under mmap_path, for buffers too large to keep in RAM
+        self.device = device
+        self.storage_device = torch.device("cpu") if mmap_path else device
+        self.obs_buf = self._alloc_obs(size, obs_dim, mmap_path, "obs")
+        self.next_obs_buf = self._alloc_obs(size, obs_dim, mmap_path, "next_obs")
+        self.acts_buf = torch.zeros([size], dtype=torch.int64, device=self.storage_device)
+        self.rews_buf = torch.zeros([size], dtype=torch.float32, device=self.storage_device)
+        self.done_buf = torch.zeros(size, dtype=torch.float32, device=self.storage_device)
+        # host staging row [obs | next_obs | act | rew | done], so a transition
+        # reaches the storage device in a single copy instead of five
+        pin = self.storage_device is not None and self.storage_device.type == "cuda"
+        self._stage = torch.zeros([2 * obs_dim + 3], dtype=torch.float32, pin_memory=pin)
+        self._stage_np = self._stage.numpy()
         self.max_size, self.batch_size = size, batch_size
         self.ptr, self.size, = 0, 0
 
-        # for N-step Learning
-        self.n_step_buffer = deque(maxlen=n_step)
+        # for N-step Learning: ring buffer holding the last n_step transitions
         self.n_step = n_step
         self.gamma = gamma
+        self._gamma_pows = (gamma ** np.arange(n_step)).astype(np.float32)
+        self._ns_obs = np.zeros([n_step, obs_dim], dtype=np.float32)
+        self._ns_act = np.zeros([n_step], dtype=np.int64)
+        self._ns_rew = np.zeros([n_step], dtype=np.float32)
+        self._ns_next_obs = np.zeros([n_step, obs_dim], dtype=np.float32)
+        self._ns_done = np.zeros([n_step], dtype=np.float32)
+        self._ns_head, self._ns_count = 0, 0
 
     def store(
             self,
             obs: np.ndarray,
-            act: np.ndarray,
+            act: int,
             rew: float,
             next_obs: np.ndarray,
             done: bool,
     ) -> Tuple[np.ndarray, np.ndarray, float, np.ndarray, bool]:
-        transition = (obs, act, rew, next_obs, done)
-        self.n_step_buffer.append(transition)
+        slot = self._ns_head
+        self._ns_obs[slot] = obs
+        self._ns_act[slot] = act
+        self._ns_rew[slot] = rew
+        self._ns_next_obs[slot] = next_obs
+        self._ns_done[slot] = done
+        self._ns_head = (slot + 1) % self.n_step
+        self._ns_count = min(self._ns_count + 1, self.n_step)
 
         # single step transition is not ready
-        if len(self.n_step_buffer) < self.n_step:
+        if self._ns_count < self.n_step:
             return ()
 
-        # make a n-step transition
-        rew, next_obs, done = self._get_n_step_info(
-            self.n_step_buffer, self.gamma
-        )
-        obs, act = self.n_step_buffer[0][:2]
-
-        self.obs_buf[self.ptr] = obs
-        self.next_obs_buf[self.ptr] = next_obs
-        self.acts_buf[self.ptr] = act
-        self.rews_buf[self.ptr] = rew
-        self.done_buf[self.ptr] = done
+        # make a n-step transition, slots ordered from oldest to newest
+        order = (self._ns_head + np.arange(self.n_step)) % self.n_step
+        rew, next_obs, done = self._get_n_step_info(order, self.gamma)
+        first = order[0]
+        obs, act = self._ns_obs[first], self._ns_act[first]
+
+        d = len(obs)
+        stage = self._stage_np
+        stage[:d] = obs
+        stage[d:2 * d] = next_obs
+        stage[2 * d:] = (act, rew, done)
+        # blocking copy: the staging row is overwritten by the next store
+        row = self._stage.to(self.storage_device)
+        self.obs_buf[self.ptr] = row[:d]
+        self.next_obs_buf[self.ptr] = row[d:2 * d]
+        self.acts_buf[self.ptr] = row[2 * d]
+        self.rews_buf[self.ptr] = row[2 * d + 1]
+        self.done_buf[self.ptr] = row[2 * d + 2]
         self.ptr = (self.ptr + 1) % self.max_size
         self.size = min(self.size + 1, self.max_size)
 
-        return self.n_step_buffer[0]
+        return (
+            obs, act, self._ns_rew[first], self._ns_next_obs[first], bool(self._ns_done[first])
+        )
+
+    def sample_batch(self) -> Dict[str, torch.Tensor]:
+        # sample with replacement (standard for DQN); collisions are negligible
+        # once the buffer is much larger than the batch
+        if self.batch_size * 1000 <= self.size:
+            idxs = torch.randint(0, self.size, (self.batch_size,), device=self.storage_device)
+        else:
+            idxs = torch.randperm(self.size, device=self.storage_device)[:self.batch_size]
 
-    def sample_batch(self) -> Dict[str, np.ndarray]:
-        idxs = np.random.choice(self.size, size=self.batch_size, replace=False)
+        samples = self._gather(idxs)
+        # for N-step Learning
+        samples["indices"] = idxs
 
-        return dict(
-            obs=self.obs_buf[idxs],
-            next_obs=self.next_obs_buf[idxs],
-            acts=self.acts_buf[idxs],
-            rews=self.rews_buf[idxs],
-            done=self.done_buf[idxs],
-            # for N-step Learning
-            indices=idxs,
-        )
+        return samples
 
     def sample_batch_from_idxs(
             self, idxs: np.ndarray
-    ) -> Dict[str, np.ndarray]:
+    ) -> Dict[str, torch.Tensor]:
         # for N-step Learning
-        return dict(
-            obs=self.obs_buf[idxs],
-            next_obs=self.next_obs_buf[idxs],
-            acts=self.acts_buf[idxs],
-            rews=self.rews_buf[idxs],
-            done=self.done_buf[idxs],
+        return self._gather(torch.as_tensor(idxs, device=self.storage_device))
+
+    def _gather(self, idxs: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """Gather transitions at idxs and move them to the training device."""
+        batch = dict(
+            obs=self.obs_buf.index_select(0, idxs),
+            next_obs=self.next_obs_buf.index_select(0, idxs),
+            acts=self.acts_buf.index_select(0, idxs),
+            rews=self.rews_buf.index_select(0, idxs),
+            done=self.done_buf.index_select(0, idxs),
         )
+        return {k: v.to(self.device, non_blocking=True) for k, v in batch.items()}
+
+    def _alloc_obs(
+            self, size: int, obs_dim: int, mmap_path: str, name: str
+    ) -> torch.Tensor:
+        """Allocate an observation buffer, file-backed when mmap_path is set."""
+        if mmap_path is None:
+            return torch.zeros([size, obs_dim], dtype=torch.float32, device=self.storage_device)
+
+        os.makedirs(mmap_path, exist_ok=True)
+        buf = np.memmap(
+            os.path.join(mmap_path, "%s.dat" % name), dtype=np.float32, mode="w+", shape=(size, obs_dim)
+        )
+        return torch.from_numpy(buf)
 
     def _get_n_step_info(
-            self, n_step_buffer: Deque, gamma: float
-    ) -> Tuple[np.int64, np.ndarray, bool]:
+            self, order: np.ndarray, gamma: float
+    ) -> Tuple[float, np.ndarray, bool]:
         """Return n step reward, next_obs, and done."""
+        rews = self._ns_rew[order]
+        dones = self._ns_done[order]
+
+        # no episode ends inside the window: plain discounted sum
+        if not dones[:-1].any():
+            return float(self._gamma_pows @ rews), self._ns_next_obs[order[-1]], bool(dones[-1])
+
         # info of the last transition
-        rew, next_obs, done = n_step_buffer[-1][-3:]
+        rew, next_obs, done = float(rews[-1]), self._ns_next_obs[order[-1]], bool(dones[-1])
 
-        for transition in reversed(list(n_step_buffer)[:-1]):
-            r, n_o, d = transition[-3:]
+        for k in range(self.n_step - 2, -1, -1):
+            r, d = float(rews[k]), float(dones[k])
 
             rew = r + gamma * rew * (1 - d)
-            next_obs, done = (n_o, d) if d else (next_obs, done)
+            next_obs, done = (self._ns_next_obs[order[k]], True) if d else (next_obs, done)
 
         return rew, next_obs, done
 
@@ -142,12 +263,14 @@ class PrioritizedReplayBuffer(ReplayBuffer):
             alpha: float = 0.6,
             n_step: int = 3,
             gamma: float = 0.95,
+            device: torch.device = None,
+            mmap_path: str = None,
     ):
         """Initialization."""
         assert alpha >= 0
 
         super(PrioritizedReplayBuffer, self).__init__(
-            obs_dim, size, batch_size, n_step, gamma
+            obs_dim, size, batch_size, n_step, gamma, device, mmap_path
         )
         self.max_priority, self.tree_ptr = 1.0, 0
         self.alpha = alpha
@@ -178,70 +301,60 @@ class PrioritizedReplayBuffer(ReplayBuffer):
 
         return transition
 
-    def sample_batch(self, beta: float = 0.4) -> Dict[str, np.ndarray]:
+    def sample_batch(self, beta: float = 0.4) -> Dict[str, torch.Tensor]:
         """Sample a batch of experiences."""
         assert len(self) >= self.batch_size
         assert beta > 0
 
         indices = self._sample_proportional()
+        samples = self._gather(torch.as_tensor(indices, device=self.storage_device))
 
-        obs = self.obs_buf[indices]
-        next_obs = self.next_obs_buf[indices]
-        acts = self.acts_buf[indices]
-        rews = self.rews_buf[indices]
-        done = self.done_buf[indices]
-        weights = np.array([self._calculate_weight(i, beta) for i in indices])
-
-        return dict(
-            obs=obs,
-            next_obs=next_obs,
-            acts=acts,
-            rews=rews,
-            done=done,
-            weights=weights,
-            indices=indices,
-        )
+        # tree reductions are shared by every weight in the batch
+        p_total = self.sum_tree.sum()
+        size = len(self)
+
+        # get max weight
+        p_min = self.min_tree.min() / p_total
+        max_weight = (p_min * size) ** (-beta)
+
+        # calculate weights
+        p_sample = self._get_priorities(indices) / p_total
+        weights = (p_sample * size) ** (-beta) / max_weight
+
+        samples["weights"] = weights
+        samples["indices"] = indices
+
+        return samples
 
-    def update_priorities(self, indices: List[int], priorities: np.ndarray):
+    def update_priorities(self, indices: np.ndarray, priorities: np.ndarray):
         """Update priorities of sampled transitions."""
         assert len(indices) == len(priorities)
 
-        for idx, priority in zip(indices, priorities):
-            assert priority > 0
-            assert 0 <= idx < len(self)
+        indices = np.asarray(indices)
+        priorities = np.asarray(priorities)
+        assert np.all(priorities > 0)
+        assert np.all((0 <= indices) & (indices < len(self)))
 
-            self.sum_tree[idx] = priority ** self.alpha
-            self.min_tree[idx] = priority ** self.alpha
+        values = priorities ** self.alpha
+        self.sum_tree.update_batch(indices, values)
+        self.min_tree.update_batch(indices, values)
 
-            self.max_priority = max(self.max_priority, priority)
+        self.max_priority = max(self.max_priority, priorities.max())
 
-    def _sample_proportional(self) -> List[int]:
+    def _sample_proportional(self) -> np.ndarray:
         """Sample indices based on proportions."""
-        indices = []
         p_total = self.sum_tree.sum(0, len(self) - 1)
         segment = p_total / self.batch_size
 
-        for i in range(self.batch_size):
-            a = segment * i
-            b = segment * (i + 1)
-            upperbound = random.uniform(a, b)
-            idx = self.sum_tree.retrieve(upperbound)
-            indices.append(idx)
+        upperbounds = np.random.uniform(0, segment, self.batch_size)
+        upperbounds += segment * np.arange(self.batch_size)
+        indices = self.sum_tree.retrieve_batch(upperbounds)
 
         return indices
 
-    def _calculate_weight(self, idx: int, beta: float):
-        """Calculate the weight of the experience at idx."""
-        # get max weight
-        p_min = self.min_tree.min() / self.sum_tree.sum()
-        max_weight = (p_min * len(self)) ** (-beta)
-
-        # calculate weights
-        p_sample = self.sum_tree[idx] / self.sum_tree.sum()
-        weight = (p_sample * len(self)) ** (-beta)
-        weight = weight / max_weight
-
-        return weight
+    def _get_priorities(self, indices: np.ndarray) -> np.ndarray:
+        """Get the priorities of the experiences at indices."""
+        return self.sum_tree.tree[self.sum_tree.capacity + np.asarray(indices)]
 
 
 class NoisyLinear(nn.Module):
@@ -282,6 +395,12 @@ class NoisyLinear(nn.Module):
         self.bias_sigma = nn.Parameter(torch.Tensor(out_features))
         self.register_buffer("bias_epsilon", torch.Tensor(out_features))
 
+        # mu + sigma * epsilon, refreshed with every new noise sample
+        self.register_buffer(
+            "_cached_weight", torch.Tensor(out_features, in_features)
+        )
+        self.register_buffer("_cached_bias", torch.Tensor(out_features))
+
         self.reset_parameters()
         self.reset_noise()
 
@@ -299,16 +418,47 @@ class NoisyLinear(nn.Module):
 
     def reset_noise(self):
         """Make new noise."""
-        epsilon_in = self.scale_noise(self.in_features)
-        epsilon_out = self.scale_noise(self.out_features)
+        device = self.weight_mu.device
+        epsilon_in = self.scale_noise(self.in_features, device)
+        epsilon_out = self.scale_noise(self.out_features, device)
+        self.set_noise(epsilon_in, epsilon_out)
 
+    def set_noise(self, epsilon_in: torch.Tensor, epsilon_out: torch.Tensor):
+        """Set factorized noise from already scaled input / output noise."""
         # outer product
-        self.weight_epsilon.copy_(epsilon_out.ger(epsilon_in))
-        self.bias_epsilon.copy_(epsilon_out)
+        self.weight_epsilon = torch.outer(epsilon_out, epsilon_in)
+        self.bias_epsilon = epsilon_out
+        self._refresh_cache()
+
+    def _refresh_cache(self):
+        """Precompute the noisy weight and bias used by gradient-free forwards."""
+        with torch.no_grad():
+            torch.addcmul(
+                self.weight_mu, self.weight_sigma, self.weight_epsilon,
+                out=self._cached_weight
+            )
+            torch.addcmul(
+                self.bias_mu, self.bias_sigma, self.bias_epsilon,
+                out=self._cached_bias
+            )
+
+    def __setstate__(self, state):
+        """Rebuild the weight cache for models pickled without it."""
+        super(NoisyLinear, self).__setstate__(state)
+        if "_cached_weight" not in self._buffers:
+            self.register_buffer("_cached_weight", torch.empty_like(self.weight_mu.data))
+            self.register_buffer("_cached_bias", torch.empty_like(self.bias_mu.data))
+            self._refresh_cache()
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Forward method implementation.
+
+        The cached weights are only valid until the next optimizer step, which
+        is always followed by reset_noise, and carry no gradient, so they are
+        used only when autograd is off.
         """
+        if not torch.is_grad_enabled():
+            return F.linear(x, self._cached_weight, self._cached_bias)
         return F.linear(
             x,
             self.weight_mu + self.weight_sigma * self.weight_epsilon,
@@ -316,9 +466,9 @@ class NoisyLinear(nn.Module):
         )
 
     @staticmethod
-    def scale_noise(size: int) -> torch.Tensor:
+    def scale_noise(size: int, device: torch.device = None) -> torch.Tensor:
         """Set scale to make noise (factorized gaussian noise)."""
-        x = torch.randn(size)
+        x = torch.randn(size, device=device)
 
         return x.sign().mul(x.abs().sqrt())
 
@@ -355,12 +505,23 @@ class Network(nn.Module):
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Forward method implementation."""
         dist = self.dist(x)
-        q = torch.sum(dist * self.support, dim=2)
+        q = dist.matmul(self.support)
 
         return q
 
     def dist(self, x: torch.Tensor) -> torch.Tensor:
         """Get distribution for atoms."""
+        dist = F.softmax(self._q_atoms(x), dim=-1)
+        dist = dist.clamp(min=1e-3)  # for avoiding nans
+
+        return dist
+
+    def log_dist(self, x: torch.Tensor) -> torch.Tensor:
+        """Get log distribution for atoms, same clamp as `dist` in log space."""
+        return F.log_softmax(self._q_atoms(x), dim=-1).clamp(min=math.log(1e-3))
+
+    def _q_atoms(self, x: torch.Tensor) -> torch.Tensor:
+        """Get dueling logits for atoms."""
         feature = self.feature_layer(x)
         adv_hid = F.relu(self.advantage_hidden_layer(feature))
         val_hid = F.relu(self.value_hidden_layer(feature))
@@ -371,17 +532,22 @@ class Network(nn.Module):
         value = self.value_layer(val_hid).view(-1, 1, self.atom_size)
         q_atoms = value + advantage - advantage.mean(dim=1, keepdim=True)
 
-        dist = F.softmax(q_atoms, dim=-1)
-        dist = dist.clamp(min=1e-3)  # for avoiding nans
-
-        return dist
+        return q_atoms
 
     def reset_noise(self):
-        """Reset all noisy layers."""
-        self.advantage_hidden_layer.reset_noise()
-        self.advantage_layer.reset_noise()
-        self.value_hidden_layer.reset_noise()
-        self.value_layer.reset_noise()
+        """Reset all noisy layers with a single random draw."""
+        layers = [
+            self.advantage_hidden_layer,
+            self.advantage_layer,
+            self.value_hidden_layer,
+            self.value_layer,
+        ]
+        sizes = [n for layer in layers for n in (layer.in_features, layer.out_features)]
+        epsilon = NoisyLinear.scale_noise(sum(sizes), layers[0].weight_mu.device)
+
+        epsilons = epsilon.split(sizes)
+        for i, layer in enumerate(layers):
+            layer.set_noise(epsilons[2 * i], epsilons[2 * i + 1])
 
 
 class DQNAgent:
@@ -424,6 +590,10 @@ class DQNAgent:
             atom_size: int = 51,
             # N-step Learning
             n_step: int = 3,
+            # torch.compile (PyTorch >= 2.0)
+            compile_model: bool = False,
+            # file-backed replay memory
+            mmap_dir: str = None,
     ):
         """Initialization.
         Args:
@@ -440,6 +610,8 @@ class DQNAgent:
             v_max (float): max value of support
             atom_size (int): the unit number of support
             n_step (int): step number to calculate n-step td error
+            compile_model (bool): whether to fuse the network kernels with torch.compile
+            mmap_dir (str): directory for memory-mapped replay observations, None keeps them in memory
         """
         obs_dim = env.observation_space.shape[1]
         action_dim = env.action_space.n
@@ -460,7 +632,8 @@ class DQNAgent:
         self.beta = beta
         self.prior_eps = prior_eps
         self.memory = PrioritizedReplayBuffer(
-            obs_dim, memory_size, batch_size, alpha=alpha
+            obs_dim, memory_size, batch_size, alpha=alpha, device=self.device,
+            mmap_path=os.path.join(mmap_dir, "per") if mmap_dir else None
         )
 
         # memory for N-step Learning
@@ -468,7 +641,9 @@ class DQNAgent:
         if self.use_n_step:
             self.n_step = n_step
             self.memory_n = ReplayBuffer(
-                obs_dim, memory_size, batch_size, n_step=n_step, gamma=gamma
+                obs_dim, memory_size, batch_size, n_step=n_step, gamma=gamma,
+                device=self.device,
+                mmap_path=os.path.join(mmap_dir, "n_step") if mmap_dir else None
             )
 
         # Categorical DQN parameters
@@ -477,7 +652,7 @@ class DQNAgent:
         self.atom_size = atom_size
         self.support = torch.linspace(
             self.v_min, self.v_max, self.atom_size
-        ).to(self.device)
+        ).to(self.device).contiguous()
 
         # networks: dqn, dqn_target
         self.dqn = Network(
@@ -489,29 +664,40 @@ class DQNAgent:
         self.dqn_target.load_state_dict(self.dqn.state_dict())
         self.dqn_target.eval()
 
+        # forward / dist take the network as first argument, so the compiled
+        # versions keep working on dqn_target and on reloaded models
+        self._q_values, self._dist = Network.forward, Network.dist
+        self._log_dist = Network.log_dist
+        if compile_model and hasattr(torch, "compile"):
+            self._q_values = torch.compile(Network.forward)
+            self._dist = torch.compile(Network.dist)
+            self._log_dist = torch.compile(Network.log_dist)
+
         # optimizer
         self.optimizer = optim.Adam(self.dqn.parameters(), lr=5e-4)
 
+        # reusable device input for single-state action selection
+        self._act_buf = torch.empty((1, obs_dim), device=self.device)
+
         # transition to store in memory
         self.transition = list()
 
         # mode: train / test
         self.is_test = False
 
-    def select_action(self, state: np.ndarray) -> np.ndarray:
+    def select_action(self, state: np.ndarray) -> int:
         """Select an action from the input state."""
         # NoisyNet: no epsilon greedy action selection
-        selected_action = self.dqn(
-            torch.FloatTensor(state).to(self.device)
-        ).argmax()
-        selected_action = selected_action.detach().cpu().numpy()
+        self._act_buf.copy_(torch.from_numpy(state), non_blocking=True)
+        with torch.inference_mode():
+            selected_action = int(self._q_values(self.dqn, self._act_buf).argmax().item())
 
         if not self.is_test:
             self.transition = [state, selected_action]
 
         return selected_action
 
-    def step(self, action: np.ndarray) -> Tuple[np.ndarray, np.float64, bool]:
+    def step(self, action: int) -> Tuple[np.ndarray, np.float64, bool]:
         """Take an action and return the response of the env."""
         next_state, reward, done, _ = self.env.step(action)
 
@@ -584,6 +770,8 @@ class DQNAgent:
         scores = []
         mean_scores = []
         score = 0
+        score_window = deque(maxlen=10)  # scores of the last 10 episodes
+        score_sum = 0.0
 
         for frame_idx in range(1, num_frames + 1):
             action = self.select_action(state)
@@ -602,9 +790,13 @@ class DQNAgent:
             if done:
                 state = self.env.reset()
                 scores.append(score)
-                if len(scores) >= 10:
-                    logger.update(score=scores[-10:], total_steps=frame_idx)
-                    mean_scores.append(np.mean(scores[-10:]))
+                if len(score_window) == score_window.maxlen:
+                    score_sum -= score_window[0]
+                score_window.append(score)
+                score_sum += score
+                if len(score_window) == score_window.maxlen:
+                    logger.update(score=list(score_window), total_steps=frame_idx)
+                    mean_scores.append(score_sum / len(score_window))
                 score = 0
 
             # if training is ready
@@ -636,35 +828,38 @@ class DQNAgent:
         done = False
         score = 0
 
-        while not done:
-            action = self.select_action(state)
-            next_state, reward, done = self.step(action)
+        with torch.inference_mode():
+            while not done:
+                action = self.select_action(state)
+                next_state, reward, done = self.step(action)
 
-            state = next_state
-            score += reward
+                state = next_state
+                score += reward
         price = 1 / (1 + np.exp(reward))
         self.env.close()
         # reset
         self.env = naive_env
         return price, score
 
-    def _compute_dqn_loss(self, samples: Dict[str, np.ndarray], gamma: float) -> torch.Tensor:
+    def _compute_dqn_loss(self, samples: Dict[str, torch.Tensor], gamma: float) -> torch.Tensor:
         """Return categorical dqn loss."""
-        device = self.device  # for shortening the following lines
-        state = torch.FloatTensor(samples["obs"]).to(device)
-        next_state = torch.FloatTensor(samples["next_obs"]).to(device)
-        action = torch.LongTensor(samples["acts"]).to(device)
-        reward = torch.FloatTensor(samples["rews"].reshape(-1, 1)).to(device)
-        done = torch.FloatTensor(samples["done"].reshape(-1, 1)).to(device)
+        # samples are already on self.device
+        state = samples["obs"]
+        next_state = samples["next_obs"]
+        action = samples["acts"]
+        reward = samples["rews"].reshape(-1, 1)
+        done = samples["done"].reshape(-1, 1)
 
         # Categorical DQN algorithm
         delta_z = float(self.v_max - self.v_min) / (self.atom_size - 1)
 
         with torch.no_grad():
             # Double DQN
-            next_action = self.dqn(next_state).argmax(1)
-            next_dist = self.dqn_target.dist(next_state)
-            next_dist = next_dist[range(self.batch_size), next_action]
+            next_action = self._q_values(self.dqn, next_state).argmax(1)
+            next_dist = self._dist(self.dqn_target, next_state)
+            next_dist = next_dist.gather(
+                1, next_action.view(-1, 1, 1).expand(-1, 1, self.atom_size)
+            ).squeeze(1)
 
             t_z = reward + (1 - done) * gamma * self.support
             t_z = t_z.clamp(min=self.v_min, max=self.v_max)
@@ -672,25 +867,17 @@ class DQNAgent:
             l = b.floor().long()
             u = b.ceil().long()
 
-            offset = (
-                torch.linspace(
-                    0, (self.batch_size - 1) * self.atom_size, self.batch_size
-                ).long()
-                .unsqueeze(1)
-                .expand(self.batch_size, self.atom_size)
-                .to(self.device)
-            )
-
+            # when b lands exactly on an atom (l == u) both weights below are 0,
+            # so put the whole probability mass on l
             proj_dist = torch.zeros(next_dist.size(), device=self.device)
-            proj_dist.view(-1).index_add_(
-                0, (l + offset).view(-1), (next_dist * (u.float() - b)).view(-1)
+            proj_dist.scatter_add_(
+                1, l, next_dist * (u.float() - b + (l == u).float())
             )
-            proj_dist.view(-1).index_add_(
-                0, (u + offset).view(-1), (next_dist * (b - l.float())).view(-1)
-            ) 
+            proj_dist.scatter_add_(1, u, next_dist * (b - l.float()))
 
-        dist = self.dqn.dist(state)
-        log_p = torch.log(dist[range(self.batch_size), action])
+        log_p = self._log_dist(self.dqn, state).gather(
+            1, action.view(-1, 1, 1).expand(-1, 1, self.atom_size)
+        ).squeeze(1)
         elementwise_loss = -(proj_dist * log_p).sum(1)
 
         return elementwise_loss
@@ -771,12 +958,46 @@ def rainbowtrain(num_frames):
         random.seed(seed)
         seed_torch(seed)
         env.seed(seed)
-        agent = DQNAgent(env, memory_size, batch_size, target_update, gamma, v_min=v_min, v_max=v_max, atom_size=atom_size, n_step=n_step)
+        agent = DQNAgent(env, memory_size, batch_size, target_update, gamma, v_min=v_min, v_max=v_max, atom_size=atom_size, n_step=n_step,
+                         compile_model=compile_model, mmap_dir=mmap_dir)
         agent.train(logger, seed, num_frames, plotting_interval=num_frames)       
         # torch.save(agent.dqn,
         #            '%sSeed%d_%s_%d_%d_Step_%d.pth' % (Expetiment_ID, seed, 'Rainbow', wnd_t, cycle_T, num_frames))
 
 
+@functools.lru_cache(maxsize=1)
+def evaluation_agent():
+    """Agent shell shared by the evaluation functions, only its dqn is swapped."""
+    return DQNAgent(env, memory_size, batch_size, target_update)
+
+
+@functools.lru_cache(maxsize=8)
+def load_dqn(path):
+    """Load a trained network once per path, ready for inference."""
+    # the checkpoints are whole pickled modules, which newer torch refuses to
+    # unpickle unless weights_only is turned off (older torch has no such flag)
+    load_kwargs = {}
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        load_kwargs["weights_only"] = False
+    dqn = torch.load(path, map_location=evaluation_agent().device, **load_kwargs)
+    dqn.eval()
+    dqn.requires_grad_(False)
+    return dqn
+
+
+@functools.lru_cache(maxsize=16)
+def make_test_env(test_data, wnd_t, cycle_T):
+    """Build an evaluation env once per (price tuple, window, cycle).
+
+    The env shuffles its episode order with np.random on construction; the
+    global state is restored so cached and fresh envs leave the same stream.
+    """
+    state = np.random.get_state()
+    test_env = gym.make('CryptoEnv-v0', data=list(test_data), wnd_t=wnd_t, cycle_T=cycle_T)
+    np.random.set_state(state)
+    return test_env
+
+
 def rainbowevaluate(path, num=0, stat=136):
     """Evaluate the agent on all the possible episodes. (refer Section 6.2 for further information)
     Args:
@@ -794,69 +1015,48 @@ def rainbowevaluate(path, num=0, stat=136):
     random.seed(seed)
     seed_torch(seed)
     env.seed(seed)
-    agent = DQNAgent(env, memory_size, batch_size, target_update)
-    agent.dqn = torch.load(path)
-    agent.dqn.eval()
+    agent = evaluation_agent()
+    agent.dqn = load_dqn(path)
 
     for test_data in test_data_list:
-        test_env = gym.make('CryptoEnv-v0', data=test_data, wnd_t=wnd_t, cycle_T=cycle_T)
+        test_env = make_test_env(tuple(test_data), wnd_t, cycle_T)
         ev_episodes = test_env.prepare_episodes()
         original_episodes = test_env.prepare_original_episodes()
-        e = 0
-        random_list = []
-        p_list = []  # picked price
-        first_day = []  # price on the 1st day
-        last_day = []  # price on the last day
-        avg_day = [] # average price
-        ratio_first_day = []
-        ratio_last_day = []
-        ratio_random_day = []
-        ratio_average_amount = []
-        t_list = []  #
-        visual_price = []
-    
-        for episode in ev_episodes:
-            refer_value = original_episodes[e][0][-2]
-            t = 0
-            for state in episode:
-                remain_t = (cycle_T - t) / cycle_T
-                price = original_episodes[e][t][-1]
-                position_value = sigmoid(price - refer_value)
-                obs = (np.concatenate(([position_value, remain_t], state)))
-                obs = obs.reshape(1, wnd_t + 2)
-
-                action = agent.dqn(
-                    torch.FloatTensor(obs).to('cuda')
-                ).argmax()
-                action = action.detach().cpu().numpy()
-
-                if action == 1 or t == cycle_T - 1:
-                    p_list.append(original_episodes[e][t][-1])
-                    first_day.append(original_episodes[e][0][-1])
-                    last_day.append(original_episodes[e][-1][-1])
-                    random_t = random.randint(0, cycle_T - 1)
-                    random_list.append(original_episodes[e][random_t][-1])
-                    period_price_list = [original_episodes[e][i][-1] for i in range(cycle_T)]
-                    avg_day.append(np.mean(np.array(period_price_list)))
-                    if e % cycle_T == 0:
-                        t_list.append(int(wnd_t + cycle_T * int(e // cycle_T) + t - 1))
-                        visual_price.append(original_episodes[e][t][-1])
-                    break
-                t += 1
-            e += 1
-            p_amount = np.sum(np.array([10000 / i for i in p_list]))
-            p_amount_list = np.array([10000 / i for i in p_list])
-            f_amount = np.sum(np.array([10000 / i for i in first_day]))
-            f_amount_list = (np.array([10000 / i for i in first_day]))
-            l_amount = np.sum(np.array([10000 / i for i in last_day]))
-            l_amount_list = (np.array([10000 / i for i in last_day]))
-            r_amount = np.sum(np.array([10000 / i for i in random_list]))
-            avg_amount = np.sum(np.array([10000 / i for i in avg_day]))
-            avg_amount_list = (np.array([10000 / i for i in avg_day]))
-            ratio_first_day.append((p_amount - f_amount) / f_amount * 100)
-            ratio_last_day.append((p_amount - l_amount) / l_amount * 100)
-            ratio_random_day.append((p_amount - r_amount) / r_amount * 100)
-            ratio_average_amount.append((p_amount - avg_amount) / avg_amount * 100)
+        # position value and remaining time of every step, computed once
+        prices = np.asarray(original_episodes, dtype=np.float64)
+        prices_mat, refer_mat = prices[..., -1], prices[..., -2]
+        pv = sigmoid(prices_mat - refer_mat[:, :1])
+        remain = (cycle_T - np.arange(cycle_T)) / cycle_T
+        obs_all = obs_to_device(build_observations(ev_episodes, pv, remain), agent.device)
+        period_means = prices_mat.mean(axis=1)
+
+        # every step of every episode in a single forward pass
+        num_episodes = len(ev_episodes)
+        with torch.inference_mode():
+            actions = agent.dqn(obs_all.view(-1, wnd_t + 2)).argmax(1)
+        actions = actions.view(num_episodes, cycle_T).cpu().numpy()
+        # picked, 1st-day and last-day price and the buy day of every episode
+        p_list, first_day, last_day, stop_t = scan_episodes(actions, np.ascontiguousarray(prices_mat), cycle_T)
+
+        # random-day baseline of every episode
+        rand_ts = np.random.randint(0, cycle_T, size=num_episodes)
+        random_list = prices_mat[np.arange(num_episodes), rand_ts]
+        avg_day = period_means  # average price
+        p_amount_list = 10000.0 / p_list
+        f_amount_list = 10000.0 / first_day
+        l_amount_list = 10000.0 / last_day
+        r_amount_list = 10000.0 / random_list
+        avg_amount_list = 10000.0 / avg_day
+        # total amount bought after each episode
+        p_amount = np.cumsum(p_amount_list)
+        f_amount = np.cumsum(f_amount_list)
+        l_amount = np.cumsum(l_amount_list)
+        r_amount = np.cumsum(r_amount_list)
+        avg_amount = np.cumsum(avg_amount_list)
+        ratio_first_day = (p_amount - f_amount) / f_amount * 100
+        ratio_last_day = (p_amount - l_amount) / l_amount * 100
+        ratio_random_day = (p_amount - r_amount) / r_amount * 100
+        ratio_average_amount = (p_amount - avg_amount) / avg_amount * 100
         result_list = [np.mean(np.array(ratio_first_day)), np.mean(np.array(ratio_last_day)), np.mean(np.array(ratio_random_day)), np.mean(np.array(ratio_average_amount))]
         print("In total:")
         if len([i for i in result_list if i>0]) >= 3:
@@ -885,69 +1085,48 @@ def SingleRainbowEvaluate(path, num=0, stat=136):
     random.seed(seed)
     seed_torch(seed)
     env.seed(seed)
-    agent = DQNAgent(env, memory_size, batch_size, target_update)
-    agent.dqn = torch.load(path)
-    agent.dqn.eval()
+    agent = evaluation_agent()
+    agent.dqn = load_dqn(path)
 
     for test_data in test_data_list:
-        test_env = gym.make('CryptoEnv-v0', data=test_data, wnd_t=wnd_t, cycle_T=cycle_T)
+        test_env = make_test_env(tuple(test_data), wnd_t, cycle_T)
         ev_episodes = test_env.prepare_episodes()
         original_episodes = test_env.prepare_original_episodes()
-
-        e = 0
-        random_list = []
-        p_list = []
-        first_day = []
-        last_day = []
-        avg_day = []
+        # only the episodes starting a new cycle are evaluated, all their steps
+        # in a single forward pass: (cycles, cycle_T, wnd_t + 2)
+        starts = range(0, len(ev_episodes), cycle_T)
+        states = np.asarray([ev_episodes[e] for e in starts], dtype=np.float32)
+        prices = np.asarray([original_episodes[e] for e in starts], dtype=np.float64)
+        prices_mat, refer_mat = prices[..., -1], prices[..., -2]
+        pv = sigmoid(prices_mat - refer_mat[:, :1])
+        remain = (cycle_T - np.arange(cycle_T)) / cycle_T
+        obs = obs_to_device(build_observations(states, pv, remain), agent.device)
+
+        num_cycles = len(starts)
+        with torch.inference_mode():
+            actions = agent.dqn(obs.view(-1, wnd_t + 2)).argmax(1)
+        actions = actions.view(num_cycles, cycle_T).cpu().numpy()
+        p_list, first_day, last_day, stop_t = scan_episodes(actions, np.ascontiguousarray(prices_mat), cycle_T)
+
+        cycles = np.arange(num_cycles)
+        # random-day baseline of every evaluated episode
+        rand_ts = np.random.randint(0, cycle_T, size=num_cycles)
+        random_list = prices_mat[cycles, rand_ts]
+        avg_day = prices_mat.mean(axis=1)
         ratio_first_day = []
         ratio_last_day = []
         ratio_random_day = []
         ratio_average_amount = []
-        t_list = []
-        visual_price = []
-    
-        for episode in ev_episodes:
-            if e % cycle_T != 0:
-                e += 1
-                continue
-            refer_value = original_episodes[e][0][-2]
-            t = 0
-            for state in episode:
-                remain_t = (cycle_T - t) / cycle_T
-                price = original_episodes[e][t][-1]
-                position_value = sigmoid(price - refer_value)
-                obs = (np.concatenate(([position_value, remain_t], state)))
-                obs = obs.reshape(1, wnd_t + 2)
-
-                action = agent.dqn(
-                    torch.FloatTensor(obs).to('cuda')
-                ).argmax()
-                action = action.detach().cpu().numpy()
-
-                if action == 1 or t == cycle_T - 1:
-                    p_list.append(original_episodes[e][t][-1])
-                    first_day.append(original_episodes[e][0][-1])
-                    last_day.append(original_episodes[e][-1][-1])
-                    random_t = random.randint(0, cycle_T - 1)
-                    random_list.append(original_episodes[e][random_t][-1])
-                    period_price_list = [original_episodes[e][i][-1] for i in range(cycle_T)]
-                    avg_day.append(np.mean(np.array(period_price_list)))
-                    if e % cycle_T == 0:
-                        t_list.append(int(wnd_t + cycle_T * int(e // cycle_T) + t - 1))
-                        visual_price.append(original_episodes[e][t][-1])
-                    break
-                t += 1
-            e += 1
-        p_amount = np.sum(np.array([10000 / i for i in p_list]))
-        p_amount_list = np.array([10000 / i for i in p_list])
-        f_amount = np.sum(np.array([10000 / i for i in first_day]))
-        f_amount_list = (np.array([10000 / i for i in first_day]))
-        l_amount = np.sum(np.array([10000 / i for i in last_day]))
-        l_amount_list = (np.array([10000 / i for i in last_day]))
-        r_amount = np.sum(np.array([10000 / i for i in random_list]))
-        avg_amount = np.sum(np.array([10000 / i for i in avg_day]))
-        avg_amount_list = (np.array([10000 / i for i in avg_day]))
+        p_amount_list = 10000.0 / p_list
+        f_amount_list = 10000.0 / first_day
+        l_amount_list = 10000.0 / last_day
+        r_amount_list = 10000.0 / random_list
+        avg_amount_list = 10000.0 / avg_day
+        p_amount = p_amount_list.sum()
+        f_amount = f_amount_list.sum()
+        l_amount = l_amount_list.sum()
+        r_amount = r_amount_list.sum()
+        avg_amount = avg_amount_list.sum()
         ratio_first_day.append((p_amount - f_amount) / f_amount * 100)
         ratio_last_day.append((p_amount - l_amount) / l_amount * 100)
         ratio_random_day.append((p_amount - r_amount) / r_amount * 100)
@@ -1021,6 +1200,8 @@ if __name__ == '__main__':
     parser.add_argument("--n_step", type=int, default=3, help="multi-step learning")
     parser.add_argument("--data_path", type=str, default=r'../data/Data.pkl', help="path to the price data")
     parser.add_argument("--mode", type=int, default=0, help="mode 0: training, mode 1: evauluation")
+    parser.add_argument("--compile", type=int, default=0, help="1: compile the network with torch.compile (PyTorch >= 2.0)")
+    parser.add_argument("--mmap_dir", type=str, default=None, help="directory for memory-mapped replay buffers (default: in memory)")
 
     args = parser.parse_args()
     num_frames = args.frames
@@ -1038,6 +1219,8 @@ if __name__ == '__main__':
     n_step = args.n_step
     data_path = args.data_path
     running_mode = args.mode
+    compile_model = bool(args.compile)
+    mmap_dir = args.mmap_dir
 
     # load original price data
     
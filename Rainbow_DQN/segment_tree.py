@@ -3,6 +3,8 @@
 import operator
 from typing import Callable
 
+import numpy as np
+
 
 class SegmentTree:
     """ Create SegmentTree.
@@ -12,7 +14,7 @@ class SegmentTree:
 
     Attributes:
         capacity (int)
-        tree (list)
+        tree (np.ndarray)
         operation (function)
 
     """
@@ -30,7 +32,7 @@ class SegmentTree:
             capacity > 0 and capacity & (capacity - 1) == 0
         ), "capacity must be positive and a power of 2."
         self.capacity = capacity
-        self.tree = [init_value for _ in range(2 * capacity)]
+        self.tree = np.full(2 * capacity, init_value, dtype=np.float64)
         self.operation = operation
 
     def _operate_helper(
@@ -69,6 +71,15 @@ class SegmentTree:
             self.tree[idx] = self.operation(self.tree[2 * idx], self.tree[2 * idx + 1])
             idx //= 2
 
+    def update_batch(self, indices: np.ndarray, values: np.ndarray):
+        """Set values of several leaves and rebuild their ancestors level by level."""
+        idx = np.asarray(indices, dtype=np.int64) + self.capacity
+        self.tree[idx] = values
+
+        while idx[0] > 1:
+            idx = np.unique(idx // 2)
+            self.tree[idx] = self.operation(self.tree[2 * idx], self.tree[2 * idx + 1])
+
     def __getitem__(self, idx: int) -> float:
         """Get real value in leaf node of tree."""
         assert 0 <= idx < self.capacity
@@ -116,6 +127,24 @@ class SumSegmentTree(SegmentTree):
                 idx = right
         return idx - self.capacity
 
+    def retrieve_batch(self, upperbounds: np.ndarray) -> np.ndarray:
+        """Vectorized `retrieve` for a batch of upper bounds."""
+        assert (
+            np.all(upperbounds >= 0) and np.all(upperbounds <= self.sum() + 1e-5)
+        ), "upperbounds: {}".format(upperbounds)
+
+        upperbounds = np.asarray(upperbounds, dtype=np.float64)
+        idx = np.ones(len(upperbounds), dtype=np.int64)
+
+        # every leaf sits at the same depth since capacity is a power of 2
+        for _ in range(self.capacity.bit_length() - 1):
+            left = 2 * idx
+            left_sum = self.tree[left]
+            go_right = upperbounds >= left_sum
+            upperbounds = np.where(go_right, upperbounds - left_sum, upperbounds)
+            idx = np.where(go_right, left + 1, left)
+        return idx - self.capacity
+
 
 class MinSegmentTree(SegmentTree):
     """ Create SegmentTree.
@@ -133,7 +162,7 @@ class MinSegmentTree(SegmentTree):
 
         """
         super(MinSegmentTree, self).__init__(
-            capacity=capacity, operation=min, init_value=float("inf")
+            capacity=capacity, operation=np.minimum, init_value=float("inf")
         )
 
     def min(self, start: int = 0, end: int = 0) -> float: